@@ -1,15 +1,39 @@
 '''Core 3CX Web GUI Auth'''
 
 # System
+import asyncio
+import concurrent.futures
+import contextlib
 import datetime
 import logging
+import os
+import shutil
+import threading
+import urllib.parse
 
 # External
 import fake_useragent
+import orjson
 import requests
+import requests.adapters
+import urllib3
 
 logger = logging.getLogger(__name__)
 
+# The user agent never changes for the life of the process, so only load the
+# fake_useragent database once.
+_UA = fake_useragent.UserAgent().firefox
+
+# Backups are typically large, read them in 1 MiB blocks.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Backups larger than this are fetched as parallel byte ranges when the
+# server supports it.
+RANGE_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+RANGE_DOWNLOAD_PARTS = 8
+# Keep-alive pool size, enough for one range-split download or as many
+# whole-file downloads in parallel.
+POOL_MAXSIZE = RANGE_DOWNLOAD_PARTS
+
 class HttpError(RuntimeError):
     '''HTTP Errors'''
 
@@ -32,17 +56,48 @@ class CXGui:
             domain = domain[:-1]
         self._domain = domain
         self._ssl = ssl
+        self._base = f"{'https' if ssl else 'http'}://{self._domain}"
+
+        # Static endpoints
+        self._url_login = self._build_url('/webclient/api/Login/GetAccessToken')
+        self._url_token = self._build_url('/connect/token')
+        self._url_backups = self._build_url('/xapi/v1/Backups')
+        self._url_pbx_backup = self._build_url('/xapi/v1/Backups/Pbx.Backup')
 
         # General initialization
-        ua = fake_useragent.UserAgent()
-        self._user_agent_str = ua.firefox
+        self._user_agent_str = _UA
+        self._headers_noauth = {
+            'Accept': 'application/json',
+            'User-Agent': self._user_agent_str,
+        }
         self._username = None
         self._password = None
         self._cookie_jar = None
         self._access_token = None
         self._refresh_token = None
         self._auth_token = None
+        self._auth_bearer = None
+        self._refresh_lock = threading.Lock()
+        self._auth_generation = 0
         self._session = requests.Session()
+        # Size the keep-alive pool so concurrent backup fetches reuse
+        # connections rather than opening new ones, and ride out transient
+        # server errors rather than aborting a long backup run.
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=POOL_MAXSIZE,
+            max_retries=urllib3.Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=(429, 502, 503, 504),
+                allowed_methods={'HEAD', 'GET', 'POST', 'DELETE'},
+                respect_retry_after_header=True,
+                # Hand the final response back so callers raise HttpError
+                raise_on_status=False,
+            ),
+        )
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
         self._timeout = 300 # 5 minutes
 
     def _build_url(self, relative_url: str) -> str:
@@ -52,24 +107,34 @@ class CXGui:
             relative_url (str): Relative URL to build upon.
 
         Returns:
-            str: _description_
+            str: Absolute URL.
         """
-        return ("https" if self._ssl else "http") + f"://{self._domain}" +\
-            ('' if relative_url[0] == '/' else '/') + relative_url
+        if relative_url.startswith('/'):
+            return self._base + relative_url
+        return self._base + '/' + relative_url
 
 
-    def _build_headers(self, include_auth: bool = True) -> dict[str,str]:
+    def _build_headers(self, include_auth: bool = True,
+                       json_body: bool = False) -> dict[str,str]:
         """Build headers for use in requests.
 
+        Args:
+            include_auth (bool, optional): Include the bearer token.
+                Defaults to True.
+            json_body (bool, optional): The request body is JSON. Defaults
+                to False.
+
         Returns:
             dict[str,str]: Headers dictionary.
         """
-        temp = {
-            'Accept': 'application/json',
-            'User-Agent': self._user_agent_str,
-        }
+        if include_auth is False and json_body is False:
+            # Safe to share, requests copies the headers it is given
+            return self._headers_noauth
+        temp = dict(self._headers_noauth)
         if include_auth is True:
-            temp['Authorization'] = f"Bearer {self._auth_token}"
+            temp['Authorization'] = self._auth_bearer
+        if json_body is True:
+            temp['Content-Type'] = 'application/json'
         return temp
 
     def _display_debug(self, response):
@@ -78,8 +143,11 @@ class CXGui:
         Args:
             response (_type_): _description_
         """
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+
         logger.debug("REQUEST")
-        logger.debug(response.request.method, response.request.url)
+        logger.debug("%s %s", response.request.method, response.request.url)
         logger.debug(response.request.headers)
         logger.debug(response.request.body)
 
@@ -107,20 +175,20 @@ class CXGui:
         self._password = password
 
         result = self._session.post(
-            url=self._build_url('/webclient/api/Login/GetAccessToken'),
-            json={
+            url=self._url_login,
+            data=orjson.dumps({
                 "ReCaptchaResponse": None,
                 "SecurityCode":"",
                 "Password":self._password,
                 "Username":self._username,
-            },
-            headers=self._build_headers(False),
+            }),
+            headers=self._build_headers(False, json_body=True),
             timeout=self._timeout,
         )
         if result.status_code not in [200]:
             raise HttpError(f"Invalid HTTP status when logging in: {result.status_code}")
 
-        result_json = result.json()
+        result_json = orjson.loads(result.content)
         if result_json['Status'] not in ['AuthSuccess']:
             raise GUIError(f"Unknown 3CX status when logging in: {result_json['Status']}")
 
@@ -130,8 +198,25 @@ class CXGui:
         self._access_token = result_json['Token']['access_token']
         self._refresh_token = result_json['Token']['refresh_token']
 
+        self._refresh()
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Tokens:\n%s\n%s\n%s",
+                self._access_token, self._refresh_token, self._auth_token)
+
+        return True
+
+    def _refresh(self):
+        """Fetch a new bearer token using the refresh token.
+
+        The refresh token is held by the session (cookie set during login) so
+        this is a single round trip and does not resend the password.
+
+        Raises:
+            HttpError: Invalid status code.
+        """
         token_result = self._session.post(
-            url=self._build_url('/connect/token'),
+            url=self._url_token,
             data={
                 'client_id': 'Webclient',
                 'grant_type': 'refresh_token',
@@ -139,41 +224,82 @@ class CXGui:
             headers=self._build_headers(False),
             timeout=self._timeout,
         )
-        result_roken_json = token_result.json()
+        if token_result.status_code not in [200]:
+            raise HttpError(
+                f"Invalid HTTP status when refreshing token: {token_result.status_code}"
+            )
+
+        result_roken_json = orjson.loads(token_result.content)
         self._auth_token = result_roken_json['access_token']
+        self._auth_bearer = f"Bearer {self._auth_token}"
+        self._auth_generation += 1
 
-        logger.debug(f"Tokens:\n{self._access_token}\n" +\
-            f"{self._refresh_token}\n{self._auth_token}")
+    def _refresh_if_stale(self, generation: int):
+        """Refresh the token unless it changed since generation was read.
 
-        return True
+        Args:
+            generation (int): Value of _auth_generation the failed request
+                was made with.
+        """
+        with self._refresh_lock:
+            # Another thread may have refreshed while we waited
+            if self._auth_generation == generation:
+                self._refresh()
 
-    def backup_fetch_list(self, fname_filter: str = None) -> dict:
-        """Fetch the backup list.
+    def _api_request(self, method: str, url: str, json_body: bool = False,
+                     headers: dict[str,str] = None, **kwargs) -> requests.Response:
+        """Make an authenticated API request, refreshing the token on 401.
 
         Args:
-            fname_filter (str, optional): Filter the list by the filename
-                specified. Defaults to None.
+            method (str): HTTP method.
+            url (str): Absolute URL.
+            json_body (bool, optional): The request body is JSON. Defaults
+                to False.
+            headers (dict[str,str], optional): Extra headers to send.
+                Defaults to None.
+
+        Returns:
+            requests.Response: Response to the request.
+        """
+        generation = self._auth_generation
+        request_headers = {**self._build_headers(json_body=json_body), **(headers or {})}
+        result = self._session.request(
+            method,
+            url,
+            headers=request_headers,
+            timeout=self._timeout,
+            **kwargs,
+        )
+        if result.status_code in [401]:
+            # Token most likely expired, refresh and try once more
+            result.close()
+            self._refresh_if_stale(generation)
+            request_headers['Authorization'] = self._auth_bearer
+            result = self._session.request(
+                method,
+                url,
+                headers=request_headers,
+                timeout=self._timeout,
+                **kwargs,
+            )
+        return result
+
+    def _backup_list_query(self, params) -> list[dict]:
+        """Query the backup list.
+
+        Args:
+            params (dict|str): Query parameters.
 
         Raises:
-            RuntimeError: _description_
+            HttpError: Invalid status code.
 
         Returns:
-            dict: _description_
+            list[dict]: Backup entries.
         """
-        logging.getLogger("urllib3").setLevel(logging.DEBUG)
-
-        result = self._session.get(
-            url=self._build_url('/xapi/v1/Backups'),
-            params={
-                '$top': 50,
-                "$skip": 0,
-                # The space after CreationTime is causing issues (should be
-                # encoded as %20 but is coming through as +).
-                #"$ordeby": urllib.parse.quote("CreationTime desc", safe=""),
-                "$select": "CreationTime,Size,FileName,DownloadLink",
-            },
-            headers=self._build_headers(),
-            timeout=self._timeout,
+        result = self._api_request(
+            'GET',
+            self._url_backups,
+            params=params,
         )
         self._display_debug(result)
 
@@ -183,12 +309,48 @@ class CXGui:
                 f"{result.status_code}"
             )
 
-        raw_json = result.json()['value']
-        if fname_filter is not None:
-            # Only return the entry matching that entry if it exists
-            output = list(filter(lambda x: x['FileName'] == fname_filter, raw_json))
-            return output
-        return raw_json
+        return orjson.loads(result.content)['value']
+
+    def backup_fetch_list(self, fname_filter: str = None) -> dict:
+        """Fetch the backup list.
+
+        Args:
+            fname_filter (str, optional): Filter the list by the filename
+                specified. Defaults to None.
+
+        Raises:
+            RuntimeError: _description_
+
+        Returns:
+            dict: _description_
+        """
+        params = {
+            '$top': 50,
+            "$skip": 0,
+            # The space after CreationTime is causing issues (should be
+            # encoded as %20 but is coming through as +).
+            #"$ordeby": urllib.parse.quote("CreationTime desc", safe=""),
+            "$select": "CreationTime,Size,FileName,DownloadLink",
+        }
+        if fname_filter is None:
+            return self._backup_list_query(params)
+
+        # Ask the server to do the filtering, OData escapes ' by doubling it.
+        # Encode the query ourselves so spaces go out as %20 rather than +.
+        escaped = fname_filter.replace("'", "''")
+        raw_json = self._backup_list_query(urllib.parse.urlencode({
+            '$top': 1,
+            "$skip": 0,
+            "$filter": f"FileName eq '{escaped}'",
+            "$select": "FileName,DownloadLink",
+        }, safe="$'", quote_via=urllib.parse.quote))
+        match = next((x for x in raw_json if x['FileName'] == fname_filter), None)
+        if match is None:
+            # Either not there yet or the server ignored $filter (and $top=1
+            # returned some other entry), check the unfiltered list.
+            raw_json = self._backup_list_query(params)
+            match = next((x for x in raw_json if x['FileName'] == fname_filter), None)
+        return [match] if match else []
 
     def backup_start(self, out_filename: str = None) -> str:
         """Trigger a new backup.
@@ -210,9 +372,11 @@ class CXGui:
             #  TODO: Add sanity checks.
             filename = out_filename
 
-        result = self._session.post(
-            url=self._build_url('/xapi/v1/Backups/Pbx.Backup'),
-            json={
+        result = self._api_request(
+            'POST',
+            self._url_pbx_backup,
+            json_body=True,
+            data=orjson.dumps({
                 'description': {
                     "Name": filename,
                     "Contents":{
@@ -227,14 +391,12 @@ class CXGui:
                         "DisableBackupCompression": False,
                     },
                 },
-            },
-            headers=self._build_headers(),
-            timeout=self._timeout,
+            }),
         )
 
         if result.status_code not in [200,204]:
             if result.status_code in [400]:
-                data = result.json()
+                data = orjson.loads(result.content)
                 if data['error']['details'][0]['message'] == "WARNINGS.XAPI.DUPLICATE":
                     logger.error("Duplicate backup detected")
                     return filename
@@ -245,24 +407,252 @@ class CXGui:
 
         return filename
 
-    def backup_download(self, download_link: str, output_file: str):
+    def _backup_download_range(self, url: str, output_file: str, start: int, end: int,
+                               cancel: threading.Event):
+        """Download a byte range of a backup into a pre-sized file.
+
+        Args:
+            url (str): Absolute URL to download from.
+            output_file (str): Output file, must already be sized to fit.
+            start (int): First byte of the range.
+            end (int): Last byte of the range (inclusive).
+            cancel (threading.Event): Stop early when set (another part failed).
+        """
+        with self._api_request(
+                    'GET',
+                    url,
+                    stream=True,
+                    headers={
+                        'Range': f"bytes={start}-{end}",
+                        # Ranges of an encoded body can't be decoded on their own
+                        'Accept-Encoding': 'identity',
+                    },
+                ) as r:
+            if r.status_code not in [206]:
+                raise HttpError(
+                    f"Invalid HTTP status when downloading range {start}-{end}: " +
+                    f"{r.status_code}"
+                )
+            # Each worker has its own handle so they don't share a file pointer
+            with open(output_file, "r+b") as f:
+                f.seek(start)
+                while not cancel.is_set():
+                    chunk = r.raw.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                received = f.tell() - start
+            if cancel.is_set():
+                return
+            # Older urllib3 doesn't enforce Content-Length, a short part would
+            # otherwise leave a zero filled hole in the file.
+            if received != end - start + 1:
+                raise HttpError(
+                    f"Incomplete range {start}-{end}: received {received} bytes"
+                )
+
+    def _backup_download_split(self, url: str, output_file: str, size: int):
+        """Download a backup as parallel byte ranges.
+
+        Args:
+            url (str): Absolute URL to download from.
+            output_file (str): Output file to save download to.
+            size (int): Total size of the backup in bytes.
+        """
+        with open(output_file, "wb") as f:
+            f.truncate(size)
+
+        part_size = -(-size // RANGE_DOWNLOAD_PARTS) # Round up
+        cancel = threading.Event()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=RANGE_DOWNLOAD_PARTS,
+                    ) as executor:
+                futures = [
+                    executor.submit(
+                        self._backup_download_range,
+                        url,
+                        output_file,
+                        start,
+                        min(start + part_size, size) - 1,
+                        cancel,
+                    )
+                    for start in range(0, size, part_size)
+                ]
+                try:
+                    concurrent.futures.wait(
+                        futures,
+                        return_when=concurrent.futures.FIRST_EXCEPTION,
+                    )
+                finally:
+                    # Stop any parts still running, the executor waits on them
+                    cancel.set()
+                for future in futures:
+                    future.result()
+        except BaseException:
+            # Don't leave a pre-sized file with holes behind
+            with contextlib.suppress(OSError):
+                os.remove(output_file)
+            raise
+
+    def backup_download(self, download_link: str, output_file: str,
+                        split: bool = True):
         """Download a backup from the 3CX server.
 
+        Large backups are split into byte ranges and downloaded over parallel
+        connections if the server supports range requests.
+
         Args:
             download_link (str): URL to download from.
             output_file (str): Output file to save download to.
+            split (bool, optional): Allow splitting into byte ranges.
+                Defaults to True.
         """
-        # This works without auth???
-        with requests.get(
-                    self._build_url(download_link),
-                    stream=True,
-                    timeout=self._timeout,
-                ) as r:
+        url = self._build_url(download_link)
+
+        if split is True:
+            head = self._api_request(
+                'HEAD',
+                url,
+                headers={'Accept-Encoding': 'identity'},
+                allow_redirects=True,
+            )
+            size = int(head.headers.get('Content-Length', 0))
+            if head.status_code in [200] and \
+                head.headers.get('Accept-Ranges') == 'bytes' and \
+                head.headers.get('Content-Encoding', 'identity') == 'identity' and \
+                size > RANGE_DOWNLOAD_THRESHOLD:
+
+                # Only follow a redirect if it stays on this server, the range
+                # requests carry the bearer token.
+                if urllib.parse.urlsplit(head.url)[:2] == urllib.parse.urlsplit(self._base)[:2]:
+                    url = head.url
+                self._backup_download_split(url, output_file, size)
+                return
+
+        with self._api_request('GET', url, stream=True) as r:
             r.raise_for_status()  # fail fast on HTTP errors
+            r.raw.decode_content = True
             with open(output_file, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:  # filters out keep-alive chunks
-                        f.write(chunk)
+                shutil.copyfileobj(r.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+
+    def backup_download_many(self, entries: list[dict], max_workers: int = 4) -> list[str]:
+        """Download several backups concurrently.
+
+        Each backup is fetched as a single stream (no range splitting) so the
+        total connections stay within the session's keep-alive pool.
+
+        Args:
+            entries (list[dict]): Backup entries as returned by
+                backup_fetch_list, each is saved under its FileName.
+            max_workers (int, optional): Number of parallel downloads, at
+                most POOL_MAXSIZE. Defaults to 4.
+
+        Raises:
+            ValueError: max_workers exceeds the session pool size.
+
+        Returns:
+            list[str]: Filenames of the downloaded backups.
+        """
+        if max_workers > POOL_MAXSIZE:
+            raise ValueError(
+                f"max_workers ({max_workers}) exceeds the connection pool size " +
+                f"({POOL_MAXSIZE})"
+            )
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    self.backup_download,
+                    entry['DownloadLink'],
+                    entry['FileName'],
+                    split=False,
+                )
+                for entry in entries
+            ]
+            # Surface the first download error, if any
+            for future in futures:
+                future.result()
+
+        return [entry['FileName'] for entry in entries]
+
+    async def _backup_download_async(self, session, download_link: str, output_file: str):
+        """Download a backup from the 3CX server using aiohttp.
+
+        Args:
+            session (aiohttp.ClientSession): Session to download with.
+            download_link (str): URL to download from.
+            output_file (str): Output file to save download to.
+        """
+        url = self._build_url(download_link)
+        for retry in [True, False]:
+            generation = self._auth_generation
+            async with session.get(
+                        url,
+                        headers={'Authorization': self._auth_bearer},
+                    ) as r:
+                expired = retry and r.status in [401]
+                if not expired:
+                    r.raise_for_status()  # fail fast on HTTP errors
+                    # Keep disk I/O off the event loop so other transfers
+                    # aren't stalled
+                    f = await asyncio.to_thread(open, output_file, "wb")
+                    try:
+                        async for chunk in r.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                            await asyncio.to_thread(f.write, chunk)
+                    finally:
+                        await asyncio.to_thread(f.close)
+                    return
+            # Token most likely expired, refresh (blocking, so in a thread)
+            # and try once more
+            await asyncio.to_thread(self._refresh_if_stale, generation)
+
+    async def backup_download_all(self, entries: list[dict]) -> list[str]:
+        """Download many backups concurrently on a single event loop.
+
+        Requires the optional aiohttp dependency (pip install cxgui[async]).
+
+        Args:
+            entries (list[dict]): Backup entries as returned by
+                backup_fetch_list, each is saved under its FileName.
+
+        Returns:
+            list[str]: Filenames of the downloaded backups.
+        """
+        import aiohttp # pylint: disable=import-outside-toplevel
+
+        connector = aiohttp.TCPConnector(limit=16, keepalive_timeout=60)
+        # Like requests, time out individual connects/reads rather than the
+        # whole transfer, which for large backups can take far longer.
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=self._timeout,
+            sock_read=self._timeout,
+        )
+        async with aiohttp.ClientSession(
+                    connector=connector,
+                    # The bearer token is added per request so it can be
+                    # refreshed mid-batch
+                    headers=self._build_headers(False),
+                    timeout=timeout,
+                ) as session:
+            tasks = [
+                asyncio.ensure_future(self._backup_download_async(
+                    session,
+                    entry['DownloadLink'],
+                    entry['FileName'],
+                ))
+                for entry in entries
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # Don't leave downloads running against a closing session
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+
+        return [entry['FileName'] for entry in entries]
 
     def backup_delete(self, filename: str):
         """Delete a backup.
@@ -272,10 +662,11 @@ class CXGui:
 
         https://<domain>/xapi/v1/Backups('CDRDump-2026-01-19.zip')
         """
-        result = self._session.delete(
-            url=self._build_url(f"/xapi/v1/Backups('{filename}')"),
-            headers=self._build_headers(),
-            timeout=self._timeout,
+        # Escape quotes the OData way (doubled) before percent-encoding
+        quoted = urllib.parse.quote(filename.replace("'", "''"), safe='')
+        result = self._api_request(
+            'DELETE',
+            "".join([self._url_backups, "('", quoted, "')"]),
         )
         if result.status_code not in [204]:
             raise HttpError(f"Invalid HTTP code '{result.status_code}' deleting backup")
@@ -293,8 +684,11 @@ if __name__ == '__main__':
     x.login(config['USERNAME'],config['PASSWORD'])
 
     output_fname = x.backup_start()
+    # Back off exponentially while waiting for the backup to appear
+    delay = 1.0
     while (backup_obj := x.backup_fetch_list(output_fname)) == []:
-        time.sleep(2)
+        time.sleep(delay)
+        delay = min(delay * 1.8, 30.0)
 
     x.backup_download(
         backup_obj[0]['DownloadLink'],
@@ -303,8 +697,9 @@ if __name__ == '__main__':
 
     with zipfile.ZipFile(output_fname) as archive:
         for curr_file in ['cdrbilling','cdroutput']:
+            # The CSVs are already UTF-8, copy the bytes straight through
             with archive.open(f'DbTables/{curr_file}.csv') as f_in, \
-                open(f'{curr_file}.csv', 'w', encoding='utf-8') as f_out:
-                f_out.write(f_in.read().decode('utf-8'))
+                open(f'{curr_file}.csv', 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
 
     x.backup_delete(output_fname)